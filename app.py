@@ -7,163 +7,375 @@ It guides the user through selecting the deployment and data type and then uploa
 """
 
 import os
+import base64
+import contextlib
+import hashlib
 import mimetypes
-from time import perf_counter
+from time import perf_counter, sleep, time
 import asyncio
+import functools
+import threading
 import streamlit as st
 import requests
 from requests.auth import HTTPBasicAuth
 import aiohttp
-from aiohttp import BasicAuth, ClientTimeout, FormData
-import nest_asyncio
-from tenacity import retry, wait_fixed, stop_after_attempt
+from aiohttp import BasicAuth, ClientTimeout
+import orjson
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
+
+API_URL = "https://connect-apps.ceh.ac.uk/ami-data-upload"
+DEPLOYMENTS_ENDPOINT = f"{API_URL}/get-deployments/"
+PRESIGNED_URL_ENDPOINT = f"{API_URL}/generate-presigned-url/"
+CHECK_FILE_EXIST_ENDPOINT = f"{API_URL}/check-file-exist/"
+
+# Maximum number of files uploaded at once
+BATCH_SIZE = 100
+
+# Largest object S3 accepts in a single PUT, and the cap on one submission
+MAX_FILE_SIZE = 5 * 1024**3
+MAX_TOTAL_SIZE = 50 * 1024**3
+
+# Deployments are kept on disk between restarts, revalidated with their ETag
+DEPLOYMENTS_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "ami-api-streamlit"
+)
+DEPLOYMENTS_CACHE_MAX_AGE = 3600
+
+# Throttling and gateway/server errors that S3 and the API return for transient faults
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+def get_http_session():
+    """
+    Returns the requests session of the current user, kept across reruns so its connections stay alive.
+    """
+    # Kept per browser session rather than shared by the app, as a requests
+    # session stores cookies and isn't safe to use from several threads
+    if "http_session" not in st.session_state:
+        st.session_state.http_session = requests.Session()
+    return st.session_state.http_session
+
+
+# Cached per credentials; failed requests raise, so they are never cached
+@st.cache_data(ttl=600, show_spinner=False)
+def fetch_deployments(user, pwd):
+    """
+    Fetches deployments from the specified URL using the provided username and password for authentication.
+    """
+    # The request is always made so the credentials are checked, but when the
+    # copy on disk is still current the server can answer 304 without a body.
+    cache_path = deployments_cache_path(user)
+    cached = load_cached_deployments(cache_path)
+    headers = {"If-None-Match": cached["etag"]} if cached else {}
+
+    response = get_http_session().get(
+        DEPLOYMENTS_ENDPOINT,
+        auth=HTTPBasicAuth(user, pwd),
+        headers=headers,
+        timeout=600,
+    )
+    if cached and response.status_code == 304:
+        deployments, etag = cached["deployments"], cached["etag"]
+    else:
+        response.raise_for_status()
+        deployments = orjson.loads(response.content)
+        etag = response.headers.get("ETag")
+
+    if etag:
+        save_cached_deployments(cache_path, deployments, etag)
+    return deployments
 
 
-nest_asyncio.apply()
+def deployments_cache_path(user):
+    """Path of the file caching the deployments of a user on disk."""
+    user_hash = hashlib.sha256(user.encode()).hexdigest()[:16]
+    return os.path.join(DEPLOYMENTS_CACHE_DIR, f"deployments-{user_hash}.json")
+
+
+def load_cached_deployments(path):
+    """Load the deployments cached on disk, or None if they are missing, unreadable or too old."""
+    try:
+        with open(path, "rb") as f:
+            cached = orjson.loads(f.read())
+        if time() - cached["fetched_at"] <= DEPLOYMENTS_CACHE_MAX_AGE:
+            return cached
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def save_cached_deployments(path, deployments, etag):
+    """Cache the deployments on disk along with their ETag and the time they were fetched."""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(
+                orjson.dumps(
+                    {"fetched_at": time(), "etag": etag, "deployments": deployments}
+                )
+            )
+    except OSError as err:
+        print(f"Could not cache deployments: {err}")
 
 
-# Function to fetch deployments from the URL with authentication
 def get_deployments(user, pwd):
     """
-    Fetches deployments from the specified URL using the provided username and password for authentication.
+    Fetches deployments for the given credentials, reporting any error to the user.
     """
     try:
-        url = "https://connect-apps.ceh.ac.uk/ami-data-upload/get-deployments/"
-        response = requests.get(url, auth=HTTPBasicAuth(user, pwd), timeout=600)
-        response.raise_for_status()
-        return response.json()
+        return fetch_deployments(user, pwd)
     except requests.exceptions.HTTPError as err:
         print(f"HTTP Error: {err}")
-        if response.status_code == 401:
+        if err.response.status_code == 401:
             st.error("Wrong username or password. Try again!")
     except Exception as err:
         st.error(f"An error occurred: {err}")
     return []
 
 
-@retry(wait=wait_fixed(2), stop=stop_after_attempt(5))
-async def get_presigned_url(
-    session, user, pwd, name, bucket, dep_id, data_type, file_name, file_type
-):
+def is_retryable(err):
+    """Whether a failed request is transient: a connection error, a timeout or a retryable status."""
+    if isinstance(err, aiohttp.ClientResponseError):
+        return err.status in RETRYABLE_STATUSES
+    return isinstance(err, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+
+# Jittered exponential backoff so concurrent uploads don't retry in lockstep
+retry_transient = retry(
+    wait=wait_random_exponential(multiplier=0.2, max=10),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception(is_retryable),
+    reraise=True,
+)
+
+
+def index_deployments(deployments):
+    """
+    Indexes the active deployments by country so the UI lookups don't rescan the whole list.
+    """
+    country_codes = {}
+    deployment_names = {}
+    deployment_ids = {}
+    for d in deployments:
+        if d["status"] != "active":
+            continue
+        country = d["country"]
+        deployment_name = f"{d['location_name']} - {d['camera_id']}"
+        # The first matching deployment wins; repeats would only duplicate options
+        if (country, deployment_name) in deployment_ids:
+            continue
+        country_codes.setdefault(country, d["country_code"])
+        deployment_names.setdefault(country, []).append(deployment_name)
+        deployment_ids[(country, deployment_name)] = d["deployment_id"]
+    return {
+        "countries": sorted(country_codes),
+        "country_codes": country_codes,
+        "deployment_names": deployment_names,
+        "deployment_ids": deployment_ids,
+    }
+
+
+@retry_transient
+async def get_presigned_url(session, auth, fields, file_name, file_type):
     """
     Fetches a presigned URL for uploading a file using the provided details.
     """
-    url = "https://connect-apps.ceh.ac.uk/ami-data-upload/generate-presigned-url/"
-
-    data = FormData()
-    data.add_field("name", name)
-    data.add_field("country", bucket)
-    data.add_field("deployment", dep_id)
-    data.add_field("data_type", data_type)
-    data.add_field("filename", file_name)
-    data.add_field("file_type", file_type)
+    data = {**fields, "filename": file_name, "file_type": file_type}
 
-    async with session.post(url, auth=BasicAuth(user, pwd), data=data) as response:
+    async with session.post(PRESIGNED_URL_ENDPOINT, auth=auth, data=data) as response:
         response.raise_for_status()
         return await response.json()
 
 
-@retry(wait=wait_fixed(2), stop=stop_after_attempt(5))
-async def upload_file_to_s3(session, presigned_url, file_content, file_type):
+@retry_transient
+async def upload_file_to_s3(session, presigned_url, file, file_type, checksum):
     """
-    Uploads a file to S3 using a presigned URL.
+    Uploads a file to S3 using a presigned URL, streaming its content in chunks.
     """
-    headers = {"Content-Type": file_type}
+    # S3 rejects chunked transfer encoding, so the size has to be sent upfront.
+    # Content-MD5 lets S3 reject the object if it was corrupted in transit.
+    headers = {
+        "Content-Type": file_type,
+        "Content-Length": str(file.size),
+        "Content-MD5": checksum,
+    }
     async with session.put(
-        presigned_url, data=file_content, headers=headers
+        presigned_url, data=read_chunks(file), headers=headers
     ) as response:
         response.raise_for_status()
 
 
-async def upload_files_in_batches(
-    user, pwd, name, bucket, dep_id, data_type, files, batch_size=100
-):
+async def upload_file(session, auth, sem, timings, fields, file):
     """
-    Uploads files in batches to S3.
+    Fetches a presigned URL for a file and uploads it as soon as the URL is available.
+    Returns an error message if no presigned URL could be obtained or the upload failed.
     """
-    async with aiohttp.ClientSession(timeout=ClientTimeout(total=1200)) as session:
-        while True:
-            files_to_upload = await check_files(
-                session, user, pwd, name, bucket, dep_id, data_type, files
-            )
-            if not files_to_upload:
-                print("All files have been uploaded successfully.")
-                break
-
-            if len(files_to_upload) <= batch_size:
-                await upload_files(
-                    session, user, pwd, name, bucket, dep_id, data_type, files_to_upload
+    async with sem:
+        # Hash the file in a thread while its presigned URL is being fetched
+        loop = asyncio.get_running_loop()
+        checksum = loop.run_in_executor(
+            None, run_timed, "checksum", timings, md5_checksum, file
+        )
+        try:
+            with timed("presign", timings):
+                presigned_url = await get_presigned_url(
+                    session, auth, fields, file.name, file.type
                 )
-            else:
-                for i in range(0, len(files_to_upload), batch_size):
-                    end = i + batch_size
-                    batch = files_to_upload[i:end]
-                    await upload_files(
-                        session, user, pwd, name, bucket, dep_id, data_type, batch
-                    )
-
-            # Update files list to only include those that still need to be checked
-            files = files_to_upload
+        except Exception as e:
+            # The file won't be uploaded, so its checksum is no longer needed
+            checksum.cancel()
+            return f"Error getting presigned URL for {file.name}: {e}"
+        checksum = await checksum
+        try:
+            with timed("upload", timings):
+                await upload_file_to_s3(
+                    session, presigned_url, file, file.type, checksum
+                )
+        except Exception as e:
+            return f"Error uploading {file.name}: {e}"
+        return None
 
 
-async def upload_files(session, user, pwd, name, bucket, dep_id, data_type, files):
+async def create_session(batch_size):
     """
-    Uploads multiple files to S3 by first obtaining presigned URLs and then uploading the files.
-
+    Creates an HTTP session whose connection pool is sized for the upload batches.
+    It is a coroutine so that the session is bound to the event loop running it.
     """
-    tasks = []
-    for file_name, file_content, file_type in files:
-        try:
-            presigned_url = await get_presigned_url(
-                session,
-                user,
-                pwd,
-                name,
-                bucket,
-                dep_id,
-                data_type,
-                file_name,
-                file_type,
-            )
-            task = upload_file_to_s3(session, presigned_url, file_content, file_type)
-            tasks.append(task)
-        except Exception as e:
-            st.error(f"Error getting presigned URL for {file_name}: {e}")
-    await asyncio.gather(*tasks)
+    # Size the pool above the request limit shared by all runs (see
+    # get_request_limit), so no request ever waits for a connection. There is
+    # no TCP_NODELAY option: aiohttp already disables Nagle on every connection.
+    connector = aiohttp.TCPConnector(
+        limit=batch_size * 2,
+        limit_per_host=batch_size * 2,
+        ttl_dns_cache=300,
+        keepalive_timeout=75,
+        enable_cleanup_closed=True,
+    )
+    # The session is shared by every user, so cookies set for one of them
+    # must not be replayed on the requests of the others
+    return aiohttp.ClientSession(
+        connector=connector,
+        cookie_jar=aiohttp.DummyCookieJar(),
+        timeout=ClientTimeout(total=1200),
+    )
 
 
-async def check_files(session, user, pwd, name, bucket, dep_id, data_type, files):
-    """Check if files exists in the object store already."""
-    files_to_upload = []
+async def upload_files_in_batches(
+    session, sem, user, pwd, fields, files, timings, progress
+):
+    """
+    Uploads files to S3 using the given session, with at most as many requests in flight as `sem` allows.
+    `fields` are the form fields identifying the deployment, sent with every request.
+    The duration of each phase is recorded in `timings` and the number of files done in `progress`.
+    Returns the error messages of the files that could not be uploaded.
+    """
+    # Auth is passed per request rather than set on the session, as the
+    # presigned S3 URLs must not receive an Authorization header.
+    auth = BasicAuth(user, pwd)
+    # Bind the arguments shared by every file once for the whole run
+    upload_one = functools.partial(upload_file, session, auth, sem, timings, fields)
+
+    # Failed requests are already retried, so a single check is enough
+    with timed("check", timings):
+        files_to_upload = await check_files(
+            functools.partial(check_file_exist, session, auth, sem, fields), files
+        )
+    print(f"{len(files) - len(files_to_upload)} files already uploaded.")
+    progress["done"] += len(files) - len(files_to_upload)
 
-    for file_path in files:
-        if not await check_file_exist(
-            session, user, pwd, name, bucket, dep_id, data_type, file_path[0]
-        ):
-            files_to_upload.append(file_path)
+    # All files are queued at once and the semaphore keeps a bounded number
+    # of them in flight, so a slow file never holds back the ones after it.
+    return await upload_files(upload_one, files_to_upload, progress)
 
-    return files_to_upload
+
+async def upload_files(upload_one, files, progress):
+    """
+    Uploads multiple files to S3 concurrently, each one getting its presigned URL and then being uploaded.
+    Counts the finished and failed files in `progress` and returns the error messages of the failed ones.
+    """
+    errors = []
+    tasks = [asyncio.ensure_future(upload_one(file)) for file in files]
+    try:
+        for upload in asyncio.as_completed(tasks):
+            error = await upload
+            if error:
+                errors.append(error)
+                progress["failed"] += 1
+            progress["done"] += 1
+    finally:
+        # The loop outlives this run, so uploads left behind by a failure
+        # would otherwise keep going in the background
+        for task in tasks:
+            task.cancel()
+    return errors
+
+
+async def check_files(check_one, files):
+    """Check if files exists in the object store already."""
+    tasks = [asyncio.ensure_future(check_one(file.name)) for file in files]
+    try:
+        exists = await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return [file for file, exist in zip(files, exists) if not exist]
 
 
-async def check_file_exist(
-    session, user, pwd, name, bucket, dep_id, data_type, file_path
-):
+@retry_transient
+async def check_file_exist(session, auth, sem, fields, file_path):
     """Check if files exists in the object store already."""
-    url = "https://connect-apps.ceh.ac.uk/ami-data-upload/check-file-exist/"
     file_name, _ = get_file_info(file_path)
-    data = FormData()
-    data.add_field("name", name)
-    data.add_field("country", bucket)
-    data.add_field("deployment", dep_id)
-    data.add_field("data_type", data_type)
-    data.add_field("filename", file_name)
-
-    async with session.post(url, auth=BasicAuth(user, pwd), data=data) as response:
+    data = {**fields, "filename": file_name}
+
+    async with sem, session.post(
+        CHECK_FILE_EXIST_ENDPOINT, auth=auth, data=data
+    ) as response:
         response.raise_for_status()
         exist = await response.json()
         return exist["exists"]
 
 
+@contextlib.contextmanager
+def timed(phase, timings):
+    """Record how long the enclosed block takes under `phase` in `timings`."""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timings.setdefault(phase, []).append(perf_counter() - start)
+
+
+def run_timed(phase, timings, func, *args):
+    """Call `func` with `args`, recording how long it takes under `phase` in `timings`."""
+    with timed(phase, timings):
+        return func(*args)
+
+
+def print_timings(timings):
+    """Print the number of calls and the p50/p95/p99 durations of each recorded phase."""
+    # A checksum still running in the executor may add a phase meanwhile
+    for phase, durations in list(timings.items()):
+        durations = sorted(durations)
+        p50, p95, p99 = (
+            durations[min(len(durations) - 1, int(q * len(durations)))]
+            for q in (0.5, 0.95, 0.99)
+        )
+        print(
+            f"{phase}: {len(durations)} calls, "
+            f"p50 {p50:.3f}s, p95 {p95:.3f}s, p99 {p99:.3f}s"
+        )
+
+
 def get_file_info(file_path):
     """Get file information including name, content, and type."""
     filename = os.path.basename(file_path)
@@ -171,11 +383,87 @@ def get_file_info(file_path):
     return filename, file_type
 
 
-def main(user, pwd, deployments):
+def md5_checksum(file):
+    """Compute the base64-encoded MD5 digest of an uploaded file, as sent in a Content-MD5 header."""
+    # getvalue() returns the bytes Streamlit already holds, while getbuffer()
+    # would make the file copy them into a buffer of its own
+    digest = hashlib.md5(file.getvalue())
+    return base64.b64encode(digest.digest()).decode()
+
+
+async def read_chunks(file, chunk_size=1024 * 1024):
+    """Yield the content of an uploaded file in chunks, as views on its bytes rather than copies."""
+    buffer = memoryview(file.getvalue())
+    for start in range(0, len(buffer), chunk_size):
+        end = start + chunk_size
+        yield buffer[start:end]
+
+
+@st.cache_resource(show_spinner=False)
+def get_event_loop():
+    """
+    Returns the event loop shared by all uploads, running in a background thread.
+    """
+    loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+@st.cache_resource(show_spinner=False)
+def get_upload_session():
+    """
+    Returns the HTTP session shared by all uploads, kept open so its connections are reused.
+    """
+    return asyncio.run_coroutine_threadsafe(
+        create_session(BATCH_SIZE), get_event_loop()
+    ).result()
+
+
+async def create_request_limit(batch_size):
+    """
+    Creates the semaphore bounding the upload requests in flight across all runs.
+    It is a coroutine so that the semaphore is bound to the event loop running it.
+    """
+    return asyncio.Semaphore(batch_size)
+
+
+@st.cache_resource(show_spinner=False)
+def get_request_limit():
+    """
+    Returns the semaphore shared by all uploads, so that together they never need
+    more connections than the upload session's pool holds.
+    """
+    return asyncio.run_coroutine_threadsafe(
+        create_request_limit(BATCH_SIZE), get_event_loop()
+    ).result()
+
+
+def wait_for_upload(future, progress):
+    """
+    Waits for an upload running on the event loop, showing its progress in the meantime.
+    """
+    progress_bar = st.progress(0.0, text="Checking files...")
+    try:
+        while not future.done():
+            if progress["done"]:
+                progress_bar.progress(
+                    progress["done"] / progress["total"],
+                    text=f"Processed {progress['done']} of {progress['total']} files, "
+                    f"{progress['failed']} failed...",
+                )
+            sleep(0.2)
+    finally:
+        # Stop the upload if the script is interrupted, e.g. by a rerun
+        future.cancel()
+    progress_bar.progress(1.0, text=f"Processed {progress['total']} files.")
+    return future.result()
+
+
+def main(user, pwd, deployment_index):
     """
     The main function to handle the user interface and interaction in the Streamlit app.
     """
-    if not deployments:
+    if not deployment_index["countries"]:
         st.error(
             "No deployments found. Please check your credentials or network connection."
         )
@@ -183,9 +471,7 @@ def main(user, pwd, deployments):
 
     full_name = st.text_input("Your Full Name:", key="full_name")
 
-    valid_country_names = list(
-        {d["country"] for d in deployments if d["status"] == "active"}
-    )
+    valid_country_names = deployment_index["countries"]
     country = st.selectbox(
         "Country:", ["Select Country"] + valid_country_names, key="country"
     )
@@ -194,10 +480,8 @@ def main(user, pwd, deployments):
         st.session_state.deployment_names = []
 
     if country != "Select Country":
-        st.session_state.deployment_names = [
-            f"{d['location_name']} - {d['camera_id']}"
-            for d in deployments
-            if d["country"] == country and d["status"] == "active"
+        st.session_state.deployment_names = deployment_index["deployment_names"][
+            country
         ]
 
     deployment = st.selectbox(
@@ -243,7 +527,7 @@ def main(user, pwd, deployments):
                 deployment,
                 data_type,
                 uploaded_files,
-                deployments,
+                deployment_index,
             )
 
 
@@ -255,7 +539,7 @@ def handle_upload(
     deployment,
     data_type,
     uploaded_files,
-    deployments,
+    deployment_index,
 ):
     """
     Handles the file upload process by validating inputs and initiating the upload.
@@ -270,62 +554,81 @@ def handle_upload(
         st.warning("Please select a data type.")
     elif not uploaded_files:
         st.warning("Please upload at least one file.")
+    # UploadedFile.size is known without reading the files
+    elif any(file.size > MAX_FILE_SIZE for file in uploaded_files):
+        st.warning(f"Files can't be larger than {MAX_FILE_SIZE // 1024**3} GB.")
+    elif sum(file.size for file in uploaded_files) > MAX_TOTAL_SIZE:
+        st.warning(
+            f"The selected files can't exceed {MAX_TOTAL_SIZE // 1024**3} GB in total."
+        )
     else:
         start_time = perf_counter()
+        timings = {}
 
         try:
-            files = [(file.name, file.read(), file.type) for file in uploaded_files]
-
-            s3_bucket_name = [
-                d["country_code"]
-                for d in deployments
-                if d["country"] == country and d["status"] == "active"
-            ][0].lower()
-            location_name, camera_id = deployment.split(" - ")
-            dep_id = [
-                d["deployment_id"]
-                for d in deployments
-                if d["country"] == country
-                and d["location_name"] == location_name
-                and d["camera_id"] == camera_id
-                and d["status"] == "active"
-            ][0]
-
-            with st.spinner("Uploading..."):
-                asyncio.run(
+            fields = {
+                "name": full_name,
+                "country": deployment_index["country_codes"][country].lower(),
+                "deployment": deployment_index["deployment_ids"][(country, deployment)],
+                "data_type": data_type,
+            }
+            # Updated from the event loop's thread and read by wait_for_upload
+            progress = {"done": 0, "failed": 0, "total": len(uploaded_files)}
+
+            errors = wait_for_upload(
+                asyncio.run_coroutine_threadsafe(
                     upload_files_in_batches(
+                        get_upload_session(),
+                        get_request_limit(),
                         user,
                         pwd,
-                        full_name,
-                        s3_bucket_name,
-                        dep_id,
-                        data_type,
-                        files,
-                    )
-                )
+                        fields,
+                        uploaded_files,
+                        timings,
+                        progress,
+                    ),
+                    get_event_loop(),
+                ),
+                progress,
+            )
 
-            st.success("Files uploaded successfully!")
+            # Streamlit elements can't be created from the event loop's thread
+            for error in errors:
+                st.error(error)
+            if errors:
+                st.error(
+                    f"{len(errors)} of {len(uploaded_files)} files failed to upload."
+                )
+            else:
+                st.success("Files uploaded successfully!")
         except Exception as e:
             st.error(f"Failed to upload files. Error: {e}")
 
         end_time = perf_counter()
         print(f"Upload files took: {end_time - start_time} seconds.")
+        print_timings(timings)
 
 
 if __name__ == "__main__":
     st.title("Upload Files")
 
-    username = st.text_input("Username:", key="username")
-    password = st.text_input("Password:", type="password", key="password")
+    # A form so that typing the credentials doesn't rerun the script
+    with st.form("login", border=False):
+        username = st.text_input("Username:", key="username")
+        password = st.text_input("Password:", type="password", key="password")
+        login = st.form_submit_button("Login")
 
-    if st.button("Login"):
+    if login:
         if username and password:
-            st.session_state.deployments = get_deployments(username, password)
+            # Only the index is kept, the raw list isn't needed once it's built
+            st.session_state.deployment_index = index_deployments(
+                get_deployments(username, password)
+            )
         else:
             st.warning("Please enter your username and password")
 
-    if "deployments" in st.session_state:
-        main(username, password, st.session_state.deployments)
+    if "deployment_index" in st.session_state:
+        main(username, password, st.session_state.deployment_index)
 
 
 # To run this app, save it as app.py